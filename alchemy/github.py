@@ -1,26 +1,44 @@
-from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 import os
-from pathlib import Path
-import re
-from typing import Generator, List, Optional, Tuple
+from threading import Lock
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple
+from logging import getLogger
 
+from cachetools import TTLCache
 from github_bot_api import Event, Webhook, GithubApp
 from github.Repository import Repository
+from github.GithubException import UnknownObjectException
 from github.GitCommit import GitCommit
 from github.PullRequest import PullRequest
 from github.InputGitTreeElement import InputGitTreeElement
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import HumanMessage
 
-from alchemy.loader import CacheOptions, ModelOptions, RepoOptions, create_simple_vector_index
+from alchemy.loader import CacheOptions, ModelOptions, RepoOptions, create_simple_vector_index, invalidate_cached_indices
+
+try:
+    # linear-time DFA matching with a literal prefilter on the URL prefix. optional, same API as the stdlib.
+    import re2 as re
+
+    # re2's \d and \s are ASCII-only already, and it takes an Options object rather than flags
+    _ascii_flags = {}
+except ImportError:
+    import re
+
+    # GitHub URLs are ASCII, so skip the Unicode tables for \d and \s
+    _ascii_flags = {"flags": re.ASCII}
+
+logger = getLogger(__name__)
 
 assert (GH_BOT_UID := int(os.environ["GH_BOT_UID"]))
 assert (GH_APP_ID := int(os.environ["GH_APP_ID"]))
 assert (GH_APP_KEY := os.environ["GH_APP_KEY"])
 assert (GH_USER_AGENT := os.environ["GH_USER_AGENT"])
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class EditTarget:
-    path: Path
+    path: str
     """File path relative to project root."""
     commit: str
     """Git commit ID"""
@@ -38,10 +56,25 @@ class EditCommand:
 
 
 # test: https://pythex.org/?regex=https%3A%2F%2Fgithub.com%2F%5B%5E%2F%5D%2B%2F%5B%5E%2F%5D%2B%2Fblob%2F(%3FP%3Ccommit%3E%5B%5E%2F%5D%2B)%2F(%3FP%3Cpath_str%3E%5B%5E%23%5D%2B)%23L(%3FP%3Cblock_start%3E%5Cd%2B)(%3F%3A-L(%3FP%3Cblock_end%3E%5Cd%2B))%3F&test_string=https%3A%2F%2Fgithub.com%2Flinuxserver%2Fdocker-sabnzbd%2Fblob%2Fmaster%2Froot%2Fetc%2Fs6-overlay%2Fs6-rc.d%2Finit-sabnzbd-config%2Frun%23L4-L7%0Ahttps%3A%2F%2Fgithub.com%2Flinuxserver%2Fdocker-sabnzbd%2Fblob%2Fmaster%2FDockerfile%23L28-L45%0Ahttps%3A%2F%2Fgithub.com%2Flinuxserver%2Fdocker-sabnzbd%2Fblob%2Fmaster%2FDockerfile%23L53%0Aasdfasdfasdf%20asdfasdfasdf%20asdfasdf%20asdfa%20sdf%20https%3A%2F%2Fgithub.com%2Flinuxserver%2Fdocker-sabnzbd%2Fblob%2Fmaster%2FDockerfile%23L53%20asdfasdf%20asdf%20asdf&ignorecase=0&multiline=0&dotall=0&verbose=0
-_target_regex = re.compile(r"https://github.com/[^/]+/[^/]+/blob/(?P<commit>[^/]+)/(?P<path_str>[^#]+)#L(?P<start>\d+)(?:-L(?P<end>\d+))?")
+# no anchor: the URL literal is distinctive enough for finditer to scan the whole body in one pass. whitespace is excluded
+# from each segment so that a match can't run across lines.
+_target_regex = re.compile(
+    r"https://github.com/[^/\s]+/[^/\s]+/blob/(?P<commit>[^/\s]+)/(?P<path_str>[^#\s]+)#L(?P<start>\d+)(?:-L(?P<end>\d+))?",
+    **_ascii_flags,
+)
 
 _app = GithubApp(user_agent=GH_USER_AGENT, app_id=GH_APP_ID, private_key=GH_APP_KEY)
 _webhook = Webhook(secret=None)
+# deliveries are dispatched synchronously, so the slow work (repo crawl, embedding, LLM calls) is handed off to a pool
+# where handlers for different issues and repos can overlap their network I/O.
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("ALCHEMY_MAX_WORKERS", 4)))
+# installation tokens last an hour, so clients are reused for a good while but refreshed well before they expire
+_clients = TTLCache(maxsize=128, ttl=30 * 60)
+# webhooks are delivered on the web server's threads, and TTLCache isn't thread-safe
+_clients_lock = Lock()
+
+# TODO: load params from env vars
+_model_opts = ModelOptions(model_name="gpt-4", temperature=0.2, request_timeout=600)
 
 _RESP_PATH_PREFIX = '%%%'
 _PROMPT_HELPER = f"""
@@ -50,48 +83,146 @@ perform an update, you must return the entire updated files. Format your respons
 markdown, as if you were editing the file directly, and prefix each file with '{_RESP_PATH_PREFIX}' followed
 by a space and the filename. eg: '{_RESP_PATH_PREFIX} relative/path/to/file.py'
 """
+_TARGETED_PROMPT_HELPER = """
+You are a software developer helping to refactor, improve, and maintain a codebase. You will be given an excerpt
+of a file followed by a request. Reply with only the updated excerpt, formatted as plaintext without markdown, as
+if you were editing the file directly.
+"""
+# splitting on this yields ["preamble", path1, content1, path2, content2, ...]
+_resp_path_regex = re.compile(rf"(?m)^{re.escape(_RESP_PATH_PREFIX)}(.*)$\n?")
+
+def _log_handler_failure(future: Future):
+    if exc := future.exception():
+        logger.error("webhook handler failed", exc_info=exc)
+
+
+def _submit(fn: Callable[..., Any], *args: Any):
+    """Run a handler on the pool, logging anything it raises rather than letting the future swallow it."""
+    _executor.submit(fn, *args).add_done_callback(_log_handler_failure)
+
 
-@_webhook.listen("*")
-def on_any_event(event: Event) -> bool:
-    print(event)
+def _get_repo(event: Event) -> Repository:
+    installation_id = event.payload["installation"]["id"]
+    with _clients_lock:
+        client = _clients.get(installation_id)
+    if not client:
+        client = _app.installation_client(installation_id)
+        with _clients_lock:
+            _clients[installation_id] = client
+    return client.get_repo(event.payload["repository"]["full_name"])
 
-    client = _app.installation_client(event.payload["installation"]["id"])
-    cmd = EditCommand(repo=client.get_repo(event["repository"]["full_name"]))
+
+@_webhook.listen("issues")
+def on_issues(event: Event) -> bool:
+    if event.payload["action"] == "opened":
+        _submit(handle_issues_opened, _get_repo(event), event)
+
+    return True
+
+
+@_webhook.listen("pull_request_review_comment")
+def on_pr_review_comment(event: Event) -> bool:
+    if event.payload["action"] == "created":
+        _submit(handle_pr_comment, _get_repo(event), event)
+
+    return True
+
+
+@_webhook.listen("push")
+def on_push(event: Event) -> bool:
+    owner, repo = event.payload["repository"]["full_name"].split("/")
+    invalidate_cached_indices(owner, repo, event.payload["ref"].removeprefix("refs/heads/"))
 
     return True
 
 
 def _get_targets_from_body(haystack: str) -> Generator[EditTarget, None, None]:
-    for line in haystack.splitlines():
-        if matches := _target_regex.match(line):
-            commit, path_str, start, end = matches.groups()
-            start = int(start)
-            end = int(end) if end else start + 1
-            yield EditTarget(Path(path_str), commit, (start, end))
+    for matches in _target_regex.finditer(haystack):
+        commit, path_str, start, end = matches.groups()
+        start = int(start)
+        end = int(end) if end else start
+        yield EditTarget(path_str, commit, (start, end))
+
+
+def _get_files_from_response(resp: str) -> List[Tuple[str, str]]:
+    """Split a freeform response into (path, content) pairs, skipping any header without a path."""
+    parts = _resp_path_regex.split(resp)
+    return [(path.strip(), content) for path, content in zip(parts[1::2], parts[2::2]) if path.strip()]
 
 
 def _create_or_update_branch(cmd: EditCommand, commit_id: str):
-    if ref := cmd.repo.get_git_ref(f"heads/{cmd.branch}"):
-        ref.edit(commit_id)
+    try:
+        cmd.repo.get_git_ref(f"heads/{cmd.branch}").edit(commit_id)
+    except UnknownObjectException:
+        cmd.repo.create_git_ref(f"refs/heads/{cmd.branch}", commit_id)
 
-    ref = cmd.repo.create_git_ref(f"refs/heads/{cmd.branch}", commit_id)
 
-def _update_file_content(repo: Repository, cmd: EditCommand, path: str, content: str, parent: GitCommit = None) -> GitCommit:
-    if not parent:
-        branch = repo.get_branch(cmd.branch) or repo.get_branch(repo.default_branch)
-        parent = branch.commit.commit
-    
+def _get_head_commit(repo: Repository, cmd: EditCommand) -> GitCommit:
+    """The tip of the command's branch, or of the default branch if it hasn't been created yet."""
+    try:
+        branch = repo.get_branch(cmd.branch)
+    except UnknownObjectException:
+        branch = repo.get_branch(repo.default_branch)
+    return branch.commit.commit
+
+
+def _update_files_content(repo: Repository, cmd: EditCommand, files: List[Tuple[str, str]], parent: GitCommit = None) -> GitCommit:
+    """Commit all of the (path, content) pairs in `files` as a single tree."""
+    parent = parent or _get_head_commit(repo, cmd)
+
     # TODO: reuse existing file mode
-    tree = repo.create_git_tree([InputGitTreeElement(path, "100644", "blob", content)], parent.tree)
+    tree = repo.create_git_tree([InputGitTreeElement(path, "100644", "blob", content) for path, content in files], parent.tree)
+
+    return repo.create_git_commit(f"Update {', '.join(path for path, _ in files)}", tree, [parent])
+
+
+def _merge_blocks(blocks: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Sort line ranges and combine any that overlap, so that splicing one can't shift the lines of another."""
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(blocks):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
 
-    return repo.create_git_commit(f"Update {path}", tree, [parent])
+def _make_targeted_changes(repo: Repository, cmd: EditCommand) -> GitCommit:
+    """Edit just the targeted blocks, prompting with each block directly rather than going through the repo index."""
+    llm = ChatOpenAI(**_model_opts.openai_kwargs)
 
+    # group by file and work bottom-up so that earlier edits don't shift the line numbers of later ones
+    targets_by_path: Dict[str, List[EditTarget]] = {}
+    for target in cmd.targets:
+        targets_by_path.setdefault(target.path, []).append(target)
 
-def _make_targeted_changes():
-    # TODO: get and update individual files
-    pass
+    # edits are made against the branch head so they don't revert anything committed since the targets were written
+    head = _get_head_commit(repo, cmd)
 
-def _make_freeform_changes(repo: Repository, cmd: EditCommand):
+    output_files: List[Tuple[str, str]] = []
+    for path, targets in targets_by_path.items():
+        content = repo.get_contents(path, ref=head.sha).decoded_content
+
+        # line numbers refer to each target's commit, so they're only meaningful if the file hasn't changed since
+        for ref in {t.commit for t in targets} - {head.sha}:
+            if repo.get_contents(path, ref=ref).decoded_content != content:
+                raise ValueError(f"{path} has changed on {cmd.branch} since {ref}, refusing to edit stale line numbers")
+
+        lines = content.decode().splitlines(keepends=True)
+        for start, end in reversed(_merge_blocks(t.block for t in targets)):
+            excerpt = "".join(lines[start - 1 : end])
+            prompt = f"{_TARGETED_PROMPT_HELPER}\n{_RESP_PATH_PREFIX} {path}\n{excerpt}\n{cmd.command}"
+            replacement = llm([HumanMessage(content=prompt)]).content
+            lines[start - 1 : end] = [replacement if replacement.endswith("\n") else replacement + "\n"]
+        output_files.append((path, "".join(lines)))
+
+    commit = _update_files_content(repo, cmd, output_files, head)
+    _create_or_update_branch(cmd, commit.sha)
+
+    return commit
+
+
+def _make_freeform_changes(repo: Repository, cmd: EditCommand) -> GitCommit:
     repo_owner, repo_name = repo.full_name.split('/')
 
     repo_opts = RepoOptions(
@@ -99,81 +230,73 @@ def _make_freeform_changes(repo: Repository, cmd: EditCommand):
         repo=repo_name
     )
 
-    # will it explode if 404?
-    if branch := repo.get_branch(cmd.branch):
-        repo_opts.branch = branch
-
-    # TODO: load params from env vars
-    model_opts = ModelOptions(model_name="gpt-4", temperature=0.2, request_timeout=600)
+    try:
+        repo.get_branch(cmd.branch)
+        repo_opts.branch = cmd.branch
+    except UnknownObjectException:
+        repo_opts.branch = repo.default_branch
 
     # TODO: cache invalidation?
     # TODO: load params from env vars
     cache_opts = CacheOptions()
 
     # TODO: connect to a dedicated vector db and refresh records when appropriate
-    index = create_simple_vector_index(repo_opts, cache_opts, model_opts)    
+    index = create_simple_vector_index(repo_opts, cache_opts, _model_opts)
 
     resp = index.query(_PROMPT_HELPER + cmd.command).response
     
     # TODO: validate filenames provided in resp and ask gpt for clarification if they can't be found.
-    OutputFile = namedtuple("OutputFile", ["path", "content"])
-    output_files: List[OutputFile] = []
-    for line in resp.splitlines():
-        if line.startswith(_RESP_PATH_PREFIX):
-            _, key = line.split(_RESP_PATH_PREFIX)
-            output_files.append(OutputFile(key.strip(), ""))
-        else:
-            output_files[-1].content += line + "\n"
+    output_files = _get_files_from_response(resp)
+    if not output_files:
+        raise ValueError(f"no files in the response, not committing to {cmd.branch}: {resp!r}")
 
-    prev_commit = None
-    for f in output_files:
-        prev_commit = _update_file_content(repo, cmd, f.path, f.content, prev_commit)
-        _create_or_update_branch(repo, branch, prev_commit.sha)
+    # one tree, one commit and one ref update no matter how many files changed
+    commit = _update_files_content(repo, cmd, output_files)
+    _create_or_update_branch(cmd, commit.sha)
 
+    return commit
 
 
 def _make_changes(repo: Repository, cmd: EditCommand) -> GitCommit:
     if cmd.targets:
-       _make_targeted_changes()
+        return _make_targeted_changes(repo, cmd)
     else:
-        _make_freeform_changes(repo, cmd)
+        return _make_freeform_changes(repo, cmd)
 
 
 def handle_issues_opened(repo: Repository, event: Event):
     """Make the changes requested in a GitHub issue and open a new PR for them."""
-    assert (body := event["issue"]["body"])
-    assert (number := event["issue"]["number"])
-    assert (title := event["issue"]["title"])
+    assert (body := event.payload["issue"]["body"])
+    assert (number := event.payload["issue"]["number"])
+    assert (title := event.payload["issue"]["title"])
 
     branch = f"bot/issue-{number}"
-    cmd_opts = {"repo": repo, "cmd": body, "branch": branch}
-    cmds = [EditCommand(**cmd_opts, t) for t in _get_targets_from_body(body)] or EditCommand(**cmd_opts)
-
-    for cmd in cmds:
-        _make_changes(cmd)
+    cmd_opts = {"repo": repo, "command": body, "branch": branch}
+    # all targets go in one command so that edits to the same file land together rather than overwriting each other
+    _make_changes(repo, EditCommand(**cmd_opts, targets=list(_get_targets_from_body(body)) or None))
 
     repo.create_pull(title, f"Closes #{number}", repo.default_branch, branch)
 
 
 def handle_pr_comment(repo: Repository, event: Event):
     REPLY_TEMPLATE = "Addressed in %s"
-    comment = event["comment"]
+    comment = event.payload["comment"]
 
     # don't respond to other people's PRs or the bot's own comments
-    assert event["pull_request"]["user"]["id"] == GH_BOT_UID
+    assert event.payload["pull_request"]["user"]["id"] == GH_BOT_UID
     assert comment["user"]["id"] != GH_BOT_UID
 
-    branch = event["pull_request"]["head"]["ref"]
-    start = int(event["start_line"] or event["line"])
+    branch = event.payload["pull_request"]["head"]["ref"]
+    start = int(comment["start_line"] or comment["line"])
 
     target = EditTarget(
         comment["path"],
         comment["commit_id"],
-        (start, int(event["line"])),
+        (start, int(comment["line"])),
     )
-    commit: GitCommit = _make_changes(EditCommand(repo=repo, command=comment["body"], targets=[target], branch=branch))
+    commit: GitCommit = _make_changes(repo, EditCommand(repo=repo, command=comment["body"], targets=[target], branch=branch))
 
-    pr = repo.get_pull(event["pull_request"]["number"])
+    pr = repo.get_pull(event.payload["pull_request"]["number"])
 
     # why doesn't intellisense see this fn?
-    pr.create_review_comment_reply(target.commit, REPLY_TEMPLATE.format(target.commit))
+    pr.create_review_comment_reply(comment["id"], REPLY_TEMPLATE % commit.sha)
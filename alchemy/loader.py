@@ -1,21 +1,38 @@
 from enum import Enum, auto
+from functools import lru_cache
+from threading import Lock
+import io
 import json
+import mmap
 import os
 import pickle
+import tempfile
 import time
-from dataclasses import asdict, dataclass, field
+from dataclasses import asdict, dataclass, field, fields
 from pathlib import Path
-from typing import Any, Dict, List, Sequence, Tuple
+from typing import Any, BinaryIO, Dict, List, Sequence, Tuple
 from logging import getLogger
 
+import numpy as np
+import orjson
+from cachetools import LRUCache
 from dotenv import load_dotenv
 from langchain.chat_models import ChatOpenAI
 from llama_index import Document, GPTListIndex, GPTSimpleVectorIndex, LLMPredictor, PromptHelper, ServiceContext, download_loader
+from llama_index.constants import DATA_KEY, VECTOR_STORE_KEY
 from llama_index.indices.knowledge_graph import GPTKnowledgeGraphIndex
+from llama_index.vector_stores.simple import SimpleVectorStore
+from llama_index.vector_stores.types import VectorStoreQueryResult
 
 download_loader("GithubRepositoryReader")
 from llama_index.readers.llamahub_modules.github_repo import GithubClient, GithubRepositoryReader
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 DEFAULT_DIRECTORY_FILTERS = ([".git", ".yarn", "node_modules"], GithubRepositoryReader.FilterType.EXCLUDE)
 DEFAULT_FILE_EXT_FILTERS = ([".zip"], GithubRepositoryReader.FilterType.EXCLUDE)
 
@@ -25,6 +42,14 @@ assert os.environ["GITHUB_TOKEN"] and os.environ["OPENAI_API_KEY"]
 
 logger = getLogger(__name__)
 
+# indices built or loaded by this process, keyed by (IndexType, owner, repo, commit sha or branch, model options) and
+# stored alongside their build time so that CacheOptions.max_age applies here as it does on disk.
+_index_cache: LRUCache = LRUCache(maxsize=32)
+_index_cache_lock = Lock()
+
+# where GPTSimpleVectorIndex.save_to_dict() keeps its embeddings, keyed by node id
+_EMBEDDING_DICT_KEYS = (VECTOR_STORE_KEY, DATA_KEY, "simple_vector_store_data_dict", "embedding_dict")
+
 
 class IndexType(Enum):
     SIMPLE_VECTOR = auto()
@@ -57,6 +82,11 @@ class ModelOptions:
     max_retries: int | None = None
     streaming: bool = False
 
+    @property
+    def openai_kwargs(self) -> Dict[str, Any]:
+        """The options which have been set, ready to pass to ChatOpenAI."""
+        return {f.name: getattr(self, f.name) for f in fields(self) if getattr(self, f.name) is not None}
+
 
 @dataclass
 class RepoOptions:
@@ -69,52 +99,184 @@ class RepoOptions:
     verbose: bool = True
     concurrent_requests: int = 10
 
+    @property
+    def cache_name(self) -> str:
+        # branches like bot/issue-1 would otherwise put the cache in a subdirectory that doesn't exist
+        ref = (self.commit_sha if self.commit_sha else self.branch).replace("/", "--")
+        return f"{self.owner}-{self.repo}-{ref}"
+
 
 @dataclass
 class CacheOptions:
     path: str | Path = "~/.alchemy"
     force_update: bool = False
     max_age: int = 60
+    quantize_embeddings: bool = True
+    """Store cached embeddings as int8 with a per-vector scale rather than float32."""
+
+    def __post_init__(self):
+        # create the cache dirs up front rather than on every write
+        (self.cache_root / "blobs").mkdir(parents=True, exist_ok=True)
+
+    @property
+    def cache_root(self) -> Path:
+        return Path(self.path).expanduser()
+
+
+class MatrixVectorStore(SimpleVectorStore):
+    """
+    SimpleVectorStore which stacks its embeddings into a single normalized float32 matrix, so that a query is one
+    matrix-vector product instead of a Python loop over every embedding.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ids: List[str] = []
+        self._matrix: np.ndarray | None = None
+
+    def add(self, *args, **kwargs):
+        self._matrix = None
+        return super().add(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        self._matrix = None
+        return super().delete(*args, **kwargs)
+
+    def _get_matrix(self) -> Tuple[List[str], np.ndarray]:
+        if self._matrix is None:
+            self._ids = list(self._data.embedding_dict)
+            matrix = np.array(list(self._data.embedding_dict.values()), dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True) if matrix.size else np.ones((0, 1), dtype=np.float32)
+            norms[norms == 0] = 1
+            self._matrix = matrix / norms
+        return self._ids, self._matrix
+
+    def query(
+        self,
+        query_embedding: List[float],
+        similarity_top_k: int,
+        doc_ids: List[str] | None = None,
+        query_str: str | None = None,
+    ) -> VectorStoreQueryResult:
+        # restricting to particular docs is left to the upstream implementation
+        if doc_ids:
+            return super().query(query_embedding, similarity_top_k, doc_ids, query_str)
+
+        ids, matrix = self._get_matrix()
+        k = min(similarity_top_k, len(ids))
+        if not k:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        q = np.asarray(query_embedding, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1
+        sims = matrix @ q
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return VectorStoreQueryResult(similarities=sims[top].tolist(), ids=[ids[i] for i in top])
+
+
+def _use_matrix_vector_store(index: GPTSimpleVectorIndex):
+    """
+    Swap a MatrixVectorStore sharing the same data into a built or loaded index.
+
+    llama-index can only save the vector store classes it knows about, so this happens after the index has been
+    cached and the index shouldn't be saved again afterwards.
+    """
+    store = MatrixVectorStore()
+    store._data = index._vector_store._data
+    index._vector_store = store
+
+
+@lru_cache(maxsize=8)
+def _build_llm_predictor(openai_opts_json: str) -> LLMPredictor:
+    return LLMPredictor(llm=ChatOpenAI(**json.loads(openai_opts_json)))
+
+
+def _get_service_context(openai_opts: Dict[str, Any]) -> ServiceContext:
+    """
+    Reuse the LLM (tokenizer tables and all) across index builds with the same options.
+
+    The rest of the service context is built fresh each time: the embed model queues texts between calls, so sharing
+    one across concurrent index builds would mix up their embeddings.
+    """
+    # model_kwargs and logit_bias are dicts, so the options are keyed by their JSON rather than a tuple of items
+    return ServiceContext.from_defaults(llm_predictor=_build_llm_predictor(json.dumps(openai_opts, sort_keys=True)))
+
+
+def _get_index_cache_key(index_type: IndexType, repo_opts: RepoOptions, model_opts: ModelOptions) -> Tuple[IndexType, str, str, str, str]:
+    # indices query with the model they were built with, so each set of model options gets its own
+    model_key = json.dumps(model_opts.openai_kwargs, sort_keys=True)
+    return (index_type, repo_opts.owner, repo_opts.repo, repo_opts.commit_sha or repo_opts.branch, model_key)
 
 
-def _get_cache_name(repo_opts: RepoOptions) -> str:
-    name = f"{repo_opts.owner}-{repo_opts.repo}"
-    name += f"-{repo_opts.commit_sha if repo_opts.commit_sha else repo_opts.branch}"
-    return name
+def invalidate_cached_indices(owner: str, repo: str, branch: str):
+    """Drop any in-memory indices built from `branch`, eg: after a push to it."""
+    with _index_cache_lock:
+        for key in [k for k in _index_cache if k[1:4] == (owner, repo, branch)]:
+            _index_cache.pop(key, None)
 
 
 def _get_cache_path(repo_opts: RepoOptions, cache_opts: CacheOptions, ext: str | None = None) -> Path:
-    cache_path = Path(cache_opts.path).expanduser()
-    name = _get_cache_name(repo_opts)
-    name += f".{ext}" if ext else ""
-    cache_path = cache_path / name
-    return cache_path
+    return cache_opts.cache_root / (repo_opts.cache_name + (f".{ext}" if ext else ""))
 
 
-def _cache_is_usable(path: Path, cache_opts: CacheOptions) -> bool:
-    return (time.time() - path.stat().st_mtime) < cache_opts.max_age or not cache_opts.force_update
+def _cache_is_usable(st: os.stat_result, cache_opts: CacheOptions) -> bool:
+    return not cache_opts.force_update and (time.time() - st.st_mtime) < cache_opts.max_age
 
 
-def _get_cache(ext: str, repo_opts: RepoOptions, cache_opts: CacheOptions) -> Any:
+def _get_cache(ext: str, repo_opts: RepoOptions, cache_opts: CacheOptions) -> memoryview | None:
     cache_path = _get_cache_path(repo_opts, cache_opts, ext)
-    if cache_path.exists() and _cache_is_usable(cache_path, cache_opts):
+    try:
+        st = os.stat(cache_path)
+    except FileNotFoundError:
+        return None
+
+    # mapping the file lets parsers read straight from the page cache instead of a copy on the Python heap. the mapping
+    # stays open for as long as the returned memoryview is referenced.
+    if st.st_size and _cache_is_usable(st, cache_opts):
         with open(cache_path, "rb") as f:
-            return f.read()
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 
 
 def _put_cache(data: Any, ext: str, repo_opts: RepoOptions, cache_opts: CacheOptions):
-    cache_path = _get_cache_path(repo_opts, cache_opts, ext)
-    os.makedirs(cache_path.parent, exist_ok=True)
+    _write_atomic(_get_cache_path(repo_opts, cache_opts, ext), data)
+
+
+def _write_atomic(cache_path: Path, data: Any):
+    # write to a temp file alongside the cache and move it into place, so a failed or concurrent write never leaves a
+    # truncated file that looks fresh to readers
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=f".{cache_path.name}.")
+    try:
+        # callables are handed the open file so they can stream into it rather than building the whole payload in memory
+        if callable(data):
+            with open(fd, "wb") as f:
+                data(f)
+        else:
+            with open(fd, "wb" if isinstance(data, bytes) else "w") as f:
+                f.write(data)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _dump_documents(docs: Sequence[Document], f: BinaryIO):
+    """Write documents to `f` as a zstd-compressed parquet table."""
+    table = pa.Table.from_pylist([{"id": d.doc_id, "text": d.text, "extra_info": json.dumps(d.extra_info)} for d in docs])
+    pq.write_table(table, f, compression="zstd")
+
 
-    mode = "wb" if isinstance(data, bytes) else "w"
-    with open(cache_path, mode) as f:
-        f.write(data)
+def _parse_documents(data: memoryview) -> List[Document]:
+    """Rebuild documents from a parquet table written by `_dump_documents`."""
+    table = pq.read_table(pa.BufferReader(data))
+    return [Document(text=r["text"], doc_id=r["id"], extra_info=json.loads(r["extra_info"])) for r in table.to_pylist()]
 
 
 def _load_documents(repo_opts: RepoOptions, cache_opts: CacheOptions) -> Sequence[Document]:
-    EXT = "docs.pkl"
+    # pyarrow is optional, fall back to pickle without it
+    EXT = "docs.parquet" if pa else "docs.pkl"
     if cache := _get_cache(EXT, repo_opts, cache_opts):
-        return pickle.loads(cache)
+        return _parse_documents(cache) if pa else pickle.loads(cache)
 
     # not all repo options are valid for the github reader
     github_opts = asdict(repo_opts)
@@ -123,33 +285,142 @@ def _load_documents(repo_opts: RepoOptions, cache_opts: CacheOptions) -> Sequenc
 
     loader = GithubRepositoryReader(GithubClient(os.environ["GITHUB_TOKEN"]), **github_opts)
     docs = loader.load_data(repo_opts.commit_sha, repo_opts.branch)
-    _put_cache(pickle.dumps(docs), EXT, repo_opts, cache_opts)
+    _put_cache(lambda f: _dump_documents(docs, f) if pa else pickle.dump(docs, f, protocol=5), EXT, repo_opts, cache_opts)
 
     return docs
 
 
+def _split_embeddings(index_dict: Dict[str, Any]) -> Tuple[Dict[str, Any], np.ndarray]:
+    """Pull the embeddings out of a saved index dict so they can be stored as a raw float array."""
+    store = index_dict
+    for key in _EMBEDDING_DICT_KEYS[:-1]:
+        store = store[key]
+    embedding_dict = store.pop(_EMBEDDING_DICT_KEYS[-1])
+    store["embedding_ids"] = list(embedding_dict)
+    return index_dict, np.array(list(embedding_dict.values()), dtype=np.float32)
+
+
+def _merge_embeddings(index_dict: Dict[str, Any], embeddings: np.ndarray) -> Dict[str, Any]:
+    """Reverse `_split_embeddings`."""
+    store = index_dict
+    for key in _EMBEDDING_DICT_KEYS[:-1]:
+        store = store[key]
+    store[_EMBEDDING_DICT_KEYS[-1]] = dict(zip(store.pop("embedding_ids"), embeddings.tolist()))
+    return index_dict
+
+
+def _dump_embeddings(embeddings: np.ndarray, quantize: bool) -> bytes:
+    """Write embeddings to an .npz, optionally quantized to int8 with a per-vector scale."""
+    buf = io.BytesIO()
+    if quantize and embeddings.size:
+        scale = np.abs(embeddings).max(axis=1) / 127
+        scale[scale == 0] = 1
+        np.savez(buf, q=np.round(embeddings / scale[:, None]).astype(np.int8), scale=scale.astype(np.float32))
+    else:
+        np.savez(buf, embeddings=embeddings)
+    return buf.getvalue()
+
+
+def _parse_embeddings(data: memoryview) -> np.ndarray:
+    """Reverse `_dump_embeddings`, dequantizing back to float32 if needed."""
+    npz = np.load(io.BytesIO(data))
+    if "q" in npz:
+        return npz["q"].astype(np.float32) * npz["scale"][:, None]
+    return npz["embeddings"]
+
+
+def _get_blob_embeddings_path(blob_sha: str, cache_opts: CacheOptions) -> Path:
+    return cache_opts.cache_root / "blobs" / f"{blob_sha}.emb.npy"
+
+
+def _build_simple_vector_index(
+    docs: Sequence[Document],
+    context: ServiceContext,
+    cache_opts: CacheOptions,
+) -> Tuple[GPTSimpleVectorIndex, Dict[str, Any]]:
+    """
+    Build a vector index, reusing chunk embeddings for any file whose git blob SHA has been embedded before.
+
+    The github reader uses each file's blob SHA as its doc_id, so a change to one file only re-embeds that file.
+    """
+    nodes = context.node_parser.get_nodes_from_documents(docs)
+    nodes_by_blob: Dict[str, List[Any]] = {}
+    for node in nodes:
+        if node.ref_doc_id:
+            nodes_by_blob.setdefault(node.ref_doc_id, []).append(node)
+
+    misses = []
+    for blob_sha, blob_nodes in nodes_by_blob.items():
+        try:
+            embeddings = None if cache_opts.force_update else np.load(_get_blob_embeddings_path(blob_sha, cache_opts))
+        except (OSError, ValueError, EOFError):
+            # missing or unreadable, either way it gets embedded again
+            embeddings = None
+
+        if embeddings is None or len(embeddings) != len(blob_nodes):
+            misses.append(blob_sha)
+            continue
+
+        # nodes which already carry an embedding are skipped when the index embeds the rest
+        for node, embedding in zip(blob_nodes, embeddings.tolist()):
+            node.embedding = embedding
+
+    index = GPTSimpleVectorIndex(nodes=nodes, service_context=context)
+    # the docstore saves each node's embedding too, which would put the reused ones back into the JSON cache as text.
+    # queries only read the vector store's copy.
+    for node in nodes:
+        node.embedding = None
+    index_dict = index.save_to_dict()
+
+    embedding_dict = index_dict
+    for key in _EMBEDDING_DICT_KEYS:
+        embedding_dict = embedding_dict[key]
+
+    for blob_sha in misses:
+        embeddings = [embedding_dict[node.get_doc_id()] for node in nodes_by_blob[blob_sha]]
+        _write_atomic(_get_blob_embeddings_path(blob_sha, cache_opts), lambda f: np.save(f, np.array(embeddings, dtype=np.float32)))
+
+    logger.info("embedded %d of %d files", len(misses), len(nodes_by_blob))
+    return index, index_dict
+
+
 def create_simple_vector_index(
     repo_opts: RepoOptions,
     cache_opts: CacheOptions,
     model_opts: ModelOptions,
 ) -> GPTSimpleVectorIndex:
     logger.info("loading simple vector index...")
-    logger.info(f"repo_opts: {asdict(repo_opts)}")
-    logger.info(f"cache_opts: {asdict(cache_opts)}")
-    logger.info(f"model_opts: {asdict(model_opts)}")
+    logger.info("repo_opts: %r", repo_opts)
+    logger.info("cache_opts: %r", cache_opts)
+    logger.info("model_opts: %r", model_opts)
 
     EXT = "sv.idx.json"
+    EMB_EXT = "sv.idx.npz"
     index: GPTSimpleVectorIndex
 
-    openai_opts = {k: v for k, v in asdict(model_opts).items() if v}
-    context = ServiceContext.from_defaults(llm_predictor=LLMPredictor(llm=ChatOpenAI(**openai_opts)))
+    key = _get_index_cache_key(IndexType.SIMPLE_VECTOR, repo_opts, model_opts)
+    with _index_cache_lock:
+        cached = _index_cache.get(key)
+    if cached and not cache_opts.force_update and (time.time() - cached[0]) < cache_opts.max_age:
+        return cached[1]
+
+    context = _get_service_context(model_opts.openai_kwargs)
     # prompt_helper = PromptHelper(max_input_size=8164, num_output=1024, max_chunk_overlap=20)
 
-    if cache := _get_cache(EXT, repo_opts, cache_opts):
-        index = GPTSimpleVectorIndex.load_from_string(cache)  # type: ignore
+    # the embeddings are kept in a separate .npz so the bulk of the index loads as a raw array rather than parsed text
+    if (cache := _get_cache(EXT, repo_opts, cache_opts)) and (emb_cache := _get_cache(EMB_EXT, repo_opts, cache_opts)):
+        index_dict = _merge_embeddings(orjson.loads(cache), _parse_embeddings(emb_cache))
+        index = GPTSimpleVectorIndex.load_from_dict(index_dict, service_context=context)  # type: ignore
     else:
-        index = GPTSimpleVectorIndex.from_documents(_load_documents(repo_opts, cache_opts), service_context=context)  # type: ignore
-        _put_cache(json.dumps(index.save_to_dict()), EXT, repo_opts, cache_opts)
+        index, index_dict = _build_simple_vector_index(_load_documents(repo_opts, cache_opts), context, cache_opts)
+        index_dict, embeddings = _split_embeddings(index_dict)
+        _put_cache(orjson.dumps(index_dict, option=orjson.OPT_NON_STR_KEYS), EXT, repo_opts, cache_opts)
+        _put_cache(_dump_embeddings(embeddings, cache_opts.quantize_embeddings), EMB_EXT, repo_opts, cache_opts)
+
+    _use_matrix_vector_store(index)
+
+    with _index_cache_lock:
+        _index_cache[key] = (time.time(), index)
 
     return index
 
@@ -160,22 +431,21 @@ def create_list_index(
     model_opts: ModelOptions,
 ) -> GPTListIndex:
     logger.info("loading simple vector index...")
-    logger.info(f"repo_opts: {asdict(repo_opts)}")
-    logger.info(f"cache_opts: {asdict(cache_opts)}")
-    logger.info(f"model_opts: {asdict(model_opts)}")
+    logger.info("repo_opts: %r", repo_opts)
+    logger.info("cache_opts: %r", cache_opts)
+    logger.info("model_opts: %r", model_opts)
 
     EXT = "l.idx.json"
     index: GPTListIndex
 
-    openai_opts = {k: v for k, v in asdict(model_opts).items() if v}
-    context = ServiceContext.from_defaults(llm_predictor=LLMPredictor(llm=ChatOpenAI(**openai_opts)))
+    context = _get_service_context(model_opts.openai_kwargs)
     # prompt_helper = PromptHelper(max_input_size=8164, num_output=1024, max_chunk_overlap=20)
 
     if 0 == 1:  # cache := _get_cache(EXT, repo_opts, cache_opts):
         index = GPTListIndex.load_from_string(cache)  # type: ignore
     else:
         index = GPTListIndex.from_documents(_load_documents(repo_opts, cache_opts), service_context=context)  # type: ignore
-        _put_cache(json.dumps(index.save_to_dict()), EXT, repo_opts, cache_opts)
+        _put_cache(orjson.dumps(index.save_to_dict(), option=orjson.OPT_NON_STR_KEYS), EXT, repo_opts, cache_opts)
 
     return index
 
@@ -188,21 +458,20 @@ def create_knowledge_graph_index(
     cache_opts = cache_opts or CacheOptions()
     model_opts = model_opts or ModelOptions()
     logger.info("loading simple vector index...")
-    logger.info(f"repo_opts: {asdict(repo_opts)}")
-    logger.info(f"cache_opts: {asdict(cache_opts)}")
-    logger.info(f"model_opts: {asdict(model_opts)}")
+    logger.info("repo_opts: %r", repo_opts)
+    logger.info("cache_opts: %r", cache_opts)
+    logger.info("model_opts: %r", model_opts)
 
     EXT = "kg.idx.json"
     index: GPTKnowledgeGraphIndex
 
-    openai_opts = {k: v for k, v in asdict(model_opts).items() if v}
-    context = ServiceContext.from_defaults(llm_predictor=LLMPredictor(llm=ChatOpenAI(**openai_opts)))
+    context = _get_service_context(model_opts.openai_kwargs)
     # prompt_helper = PromptHelper(max_input_size=8164, num_output=1024, max_chunk_overlap=20)
 
     if 0 == 1:  # cache := _get_cache(EXT, repo_opts, cache_opts):
         index = GPTKnowledgeGraphIndex.load_from_string(cache)  # type: ignore
     else:
         index = GPTKnowledgeGraphIndex.from_documents(_load_documents(repo_opts, cache_opts), service_context=context)  # type: ignore
-        _put_cache(json.dumps(index.save_to_dict()), EXT, repo_opts, cache_opts)
+        _put_cache(orjson.dumps(index.save_to_dict(), option=orjson.OPT_NON_STR_KEYS), EXT, repo_opts, cache_opts)
 
     return index
@@ -0,0 +1,16 @@
+import os
+
+from dotenv import load_dotenv
+
+# alchemy's modules check for credentials at import time. load any real ones first, then fill in placeholders so that
+# the tests which don't talk to GitHub or OpenAI can still import them.
+load_dotenv()
+for var, value in {
+    "GITHUB_TOKEN": "test",
+    "OPENAI_API_KEY": "test",
+    "GH_BOT_UID": "1",
+    "GH_APP_ID": "1",
+    "GH_APP_KEY": "test",
+    "GH_USER_AGENT": "alchemy-tests",
+}.items():
+    os.environ.setdefault(var, value)
@@ -0,0 +1,151 @@
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytest
+from github.GithubException import UnknownObjectException
+
+from alchemy import github
+from alchemy.github import (
+    EditCommand,
+    EditTarget,
+    _get_files_from_response,
+    _get_targets_from_body,
+    _make_targeted_changes,
+    _merge_blocks,
+    _resp_path_regex,
+)
+
+
+def test_targets_from_body():
+    body = """
+please fix these:
+https://github.com/linuxserver/docker-sabnzbd/blob/master/root/etc/s6-overlay/s6-rc.d/init-sabnzbd-config/run#L4-L7
+https://github.com/linuxserver/docker-sabnzbd/blob/0a1b2c3/Dockerfile#L53
+and this one mid-sentence https://github.com/linuxserver/docker-sabnzbd/blob/master/Dockerfile#L28-L45 too
+"""
+    assert list(_get_targets_from_body(body)) == [
+        EditTarget("root/etc/s6-overlay/s6-rc.d/init-sabnzbd-config/run", "master", (4, 7)),
+        EditTarget("Dockerfile", "0a1b2c3", (53, 53)),
+        EditTarget("Dockerfile", "master", (28, 45)),
+    ]
+
+
+def test_targets_from_body_ignores_other_links():
+    body = "see https://github.com/inhumantsar/alchemy/issues/1 and https://github.com/inhumantsar/alchemy/blob/main/README.md"
+    assert list(_get_targets_from_body(body)) == []
+
+
+def test_resp_path_regex_splits_files():
+    resp = """Sure, here are the updated files:
+%%% src/app.py
+import os
+
+print(os.getcwd())
+%%% README.md
+# app
+"""
+    parts = _resp_path_regex.split(resp)
+    assert parts[0] == "Sure, here are the updated files:\n"
+    assert _get_files_from_response(resp) == [
+        ("src/app.py", "import os\n\nprint(os.getcwd())\n"),
+        ("README.md", "# app\n"),
+    ]
+
+
+def test_resp_path_regex_ignores_prefix_mid_line():
+    assert len(_resp_path_regex.split("use %%% as a separator\n")) == 1
+
+
+def test_files_from_response_skip_headers_without_a_path():
+    assert _get_files_from_response("%%%\nstray\n%%% a.py\nx\n") == [("a.py", "x\n")]
+    assert _get_files_from_response("I can't do that.") == []
+
+
+class _StubRepo:
+    """Just enough of a PyGithub Repository for _make_targeted_changes, with files keyed by ref then path."""
+
+    default_branch = "main"
+
+    def __init__(self, files: Dict[str, Dict[str, str]]):
+        self.files = files
+        self.head = SimpleNamespace(sha="head", tree="head-tree")
+        self.trees: List[Dict[str, str]] = []
+        self.refs: Dict[str, str] = {}
+
+    def get_branch(self, name):
+        return SimpleNamespace(commit=SimpleNamespace(commit=self.head))
+
+    def get_contents(self, path, ref):
+        return SimpleNamespace(decoded_content=self.files[ref][path].encode())
+
+    def create_git_tree(self, elements, base_tree):
+        self.trees.append({e._identity["path"]: e._identity["content"] for e in elements})
+        return "new-tree"
+
+    def create_git_commit(self, message, tree, parents):
+        return SimpleNamespace(sha="new", message=message, tree=tree, parents=parents)
+
+    def get_git_ref(self, ref):
+        raise UnknownObjectException(404, {}, {})
+
+    def create_git_ref(self, ref, sha):
+        self.refs[ref] = sha
+
+
+@pytest.fixture
+def prompts(monkeypatch):
+    """Replace the LLM with one which records its prompts and replies with a fixed line."""
+    prompts = []
+
+    class StubLLM:
+        def __init__(self, **kwargs):
+            pass
+
+        def __call__(self, messages):
+            prompts.append(messages[0].content)
+            return SimpleNamespace(content="EDITED")
+
+    monkeypatch.setattr(github, "ChatOpenAI", StubLLM)
+    return prompts
+
+
+_TEN_LINES = "".join(f"{i}\n" for i in range(1, 11))
+
+
+def _targeted_command(repo: _StubRepo, *targets: EditTarget) -> EditCommand:
+    return EditCommand(repo=repo, command="fix it", branch="bot/issue-1", targets=list(targets))
+
+
+def test_targeted_changes_splice_bottom_up(prompts):
+    repo = _StubRepo({"head": {"a.py": _TEN_LINES, "b.py": "b\n"}})
+    cmd = _targeted_command(
+        repo, EditTarget("a.py", "head", (2, 3)), EditTarget("a.py", "head", (6, 6)), EditTarget("b.py", "head", (1, 1))
+    )
+
+    commit = _make_targeted_changes(repo, cmd)
+
+    assert len(prompts) == 3
+    assert repo.trees == [{"a.py": "1\nEDITED\n4\n5\nEDITED\n7\n8\n9\n10\n", "b.py": "EDITED\n"}]
+    assert commit.parents == [repo.head]
+    assert repo.refs == {"refs/heads/bot/issue-1": "new"}
+
+
+def test_targeted_changes_merge_overlapping_blocks(prompts):
+    repo = _StubRepo({"head": {"a.py": _TEN_LINES}})
+    _make_targeted_changes(repo, _targeted_command(repo, EditTarget("a.py", "head", (4, 10)), EditTarget("a.py", "head", (6, 8))))
+
+    assert len(prompts) == 1
+    assert "\n4\n5\n6\n7\n8\n9\n10\n" in prompts[0]
+    assert repo.trees == [{"a.py": "1\n2\n3\nEDITED\n"}]
+
+
+def test_targeted_changes_refuse_stale_line_numbers(prompts):
+    repo = _StubRepo({"head": {"a.py": _TEN_LINES}, "old": {"a.py": "0\n" + _TEN_LINES}})
+
+    with pytest.raises(ValueError):
+        _make_targeted_changes(repo, _targeted_command(repo, EditTarget("a.py", "old", (2, 2))))
+    assert not prompts and not repo.trees
+
+
+def test_merge_blocks():
+    assert _merge_blocks([(6, 8), (4, 10), (12, 12), (1, 2), (2, 3)]) == [(1, 3), (4, 10), (12, 12)]
@@ -1,6 +1,31 @@
+import copy
+import os
+
+import numpy as np
+import orjson
 import pytest
 
-from alchemy.loader import RepoOptions, CacheOptions, ModelOptions, create_simple_vector_index, _get_cache_path
+from alchemy.loader import (
+    IndexType,
+    MatrixVectorStore,
+    RepoOptions,
+    CacheOptions,
+    ModelOptions,
+    create_simple_vector_index,
+    invalidate_cached_indices,
+    _index_cache,
+    _get_cache,
+    _get_index_cache_key,
+    _get_cache_path,
+    _build_simple_vector_index,
+    _cache_is_usable,
+    _dump_embeddings,
+    _get_blob_embeddings_path,
+    _merge_embeddings,
+    _parse_embeddings,
+    _put_cache,
+    _split_embeddings,
+)
 from llama_index import GPTSimpleVectorIndex, ServiceContext
 from langchain.chat_models import ChatOpenAI
 
@@ -29,3 +54,155 @@ def test_cache_created(repo_opts, cache_opts, model_opts):
     create_simple_vector_index(repo_opts, cache_opts, model_opts)
     cache_path = _get_cache_path(repo_opts, cache_opts, "idx.json")
     assert cache_path.exists()
+
+
+def _saved_simple_index() -> dict:
+    from llama_index.data_structs.node_v2 import DocumentRelationship, Node
+
+    nodes = [
+        Node(text=f"node {i}", doc_id=f"node-{i}", embedding=[float(i), 1.0, -0.5], relationships={DocumentRelationship.SOURCE: "doc"})
+        for i in range(3)
+    ]
+    return GPTSimpleVectorIndex(nodes=nodes, service_context=ServiceContext.from_defaults()).save_to_dict()
+
+
+def test_split_merge_embeddings_round_trip():
+    saved = _saved_simple_index()
+    index_dict, embeddings = _split_embeddings(copy.deepcopy(saved))
+    assert embeddings.shape == (3, 3)
+
+    restored = _merge_embeddings(orjson.loads(orjson.dumps(index_dict, option=orjson.OPT_NON_STR_KEYS)), embeddings)
+    # node relationships are keyed by an enum, which comes back as its string value
+    assert restored == orjson.loads(orjson.dumps(saved, option=orjson.OPT_NON_STR_KEYS))
+    assert isinstance(GPTSimpleVectorIndex.load_from_dict(restored), GPTSimpleVectorIndex)
+
+
+def test_quantized_embeddings_round_trip():
+    embeddings = np.random.default_rng(0).normal(size=(16, 1536)).astype(np.float32)
+    embeddings[3] = 0
+
+    parsed = _parse_embeddings(memoryview(_dump_embeddings(embeddings, quantize=True)))
+    assert parsed.dtype == np.float32
+    assert parsed.shape == embeddings.shape
+    # rounding to the nearest int8 step is off by at most half a step per vector
+    step = np.abs(embeddings).max(axis=1, keepdims=True) / 127
+    assert np.all(np.abs(parsed - embeddings) <= step / 2 + 1e-6)
+    assert not parsed[3].any()
+
+
+def test_unquantized_embeddings_round_trip():
+    embeddings = np.random.default_rng(0).normal(size=(4, 8)).astype(np.float32)
+    assert np.array_equal(_parse_embeddings(memoryview(_dump_embeddings(embeddings, quantize=False))), embeddings)
+
+
+def test_empty_embeddings_round_trip():
+    embeddings = np.zeros((0, 1536), dtype=np.float32)
+    assert _parse_embeddings(memoryview(_dump_embeddings(embeddings, quantize=True))).shape == (0, 1536)
+
+
+def test_cache_is_usable(tmp_path):
+    cache_file = tmp_path / "cache"
+    cache_file.write_bytes(b"{}")
+
+    assert _cache_is_usable(os.stat(cache_file), CacheOptions(path=tmp_path))
+    assert not _cache_is_usable(os.stat(cache_file), CacheOptions(path=tmp_path, force_update=True))
+
+    os.utime(cache_file, (0, 0))
+    assert not _cache_is_usable(os.stat(cache_file), CacheOptions(path=tmp_path))
+
+
+def test_index_cache_key_includes_model_options():
+    repo_opts = RepoOptions(owner="o", repo="r", branch="main")
+    gpt4 = _get_index_cache_key(IndexType.SIMPLE_VECTOR, repo_opts, ModelOptions(model_name="gpt-4"))
+    gpt35 = _get_index_cache_key(IndexType.SIMPLE_VECTOR, repo_opts, ModelOptions(model_name="gpt-3.5-turbo"))
+    assert gpt4 != gpt35
+
+    _index_cache[gpt4] = _index_cache[gpt35] = (0, None)
+    invalidate_cached_indices("o", "r", "main")
+    assert gpt4 not in _index_cache and gpt35 not in _index_cache
+
+
+def test_build_simple_vector_index_reuses_blob_embeddings(tmp_path):
+    from llama_index import Document
+    from llama_index.token_counter.mock_embed_model import MockEmbedding
+
+    class RecordingEmbedding(MockEmbedding):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.texts = []
+
+        def _get_text_embedding(self, text):
+            self.texts.append(text)
+            return super()._get_text_embedding(text)
+
+    cache_opts = CacheOptions(path=tmp_path)
+    np.save(_get_blob_embeddings_path("blob-a", cache_opts), np.full((1, 4), 0.25, dtype=np.float32))
+    # a torn write from another build is treated as a miss rather than an error
+    _get_blob_embeddings_path("blob-c", cache_opts).write_bytes(b"\x93NUMPY")
+
+    embed_model = RecordingEmbedding(4)
+    docs = [Document(text=f"file {name}", doc_id=f"blob-{name}") for name in "abc"]
+    _, index_dict = _build_simple_vector_index(docs, ServiceContext.from_defaults(embed_model=embed_model), cache_opts)
+
+    assert sorted(embed_model.texts) == ["file b", "file c"]
+    assert sorted(map(tuple, _split_embeddings(index_dict)[1].tolist())) == [(0.25,) * 4, (0.5,) * 4, (0.5,) * 4]
+    assert np.load(_get_blob_embeddings_path("blob-c", cache_opts)).tolist() == [[0.5] * 4]
+    # the docstore doesn't keep a second copy of the embeddings
+    assert all(doc["embedding"] is None for doc in index_dict["docstore"]["docs"].values())
+
+
+def _vector_stores(n: int = 50, dim: int = 16):
+    from llama_index.data_structs.node_v2 import Node
+    from llama_index.vector_stores.simple import SimpleVectorStore
+    from llama_index.vector_stores.types import NodeEmbeddingResult
+
+    rng = np.random.default_rng(0)
+    results = [
+        NodeEmbeddingResult(f"node-{i}", Node(text=f"node {i}", doc_id=f"node-{i}"), rng.normal(size=dim).tolist(), f"doc-{i % 5}")
+        for i in range(n)
+    ]
+    simple, matrix = SimpleVectorStore(), MatrixVectorStore()
+    simple.add(results)
+    matrix.add(results)
+    return simple, matrix, rng
+
+
+def test_matrix_vector_store_matches_simple():
+    simple, matrix, rng = _vector_stores()
+    for _ in range(5):
+        query = rng.normal(size=16).tolist()
+        expected, actual = simple.query(query, 5), matrix.query(query, 5)
+        assert actual.ids == expected.ids
+        assert np.allclose(actual.similarities, expected.similarities, atol=1e-5)
+
+
+def test_matrix_vector_store_top_k_larger_than_store():
+    _, matrix, rng = _vector_stores(n=3)
+    assert len(matrix.query(rng.normal(size=16).tolist(), 10).ids) == 3
+    assert MatrixVectorStore().query(rng.normal(size=16).tolist(), 10).ids == []
+
+
+def test_matrix_vector_store_add_invalidates_matrix():
+    from llama_index.data_structs.node_v2 import Node
+    from llama_index.vector_stores.types import NodeEmbeddingResult
+
+    _, matrix, _ = _vector_stores()
+    query = [1.0] + [0.0] * 15
+    matrix.query(query, 1)
+    matrix.add([NodeEmbeddingResult("new", Node(text="new", doc_id="new"), query, "doc-new")])
+    assert matrix.query(query, 1).ids == ["new"]
+
+
+def test_matrix_vector_store_defers_doc_ids_upstream():
+    simple, matrix, rng = _vector_stores()
+    query = rng.normal(size=16).tolist()
+    assert matrix.query(query, 3, doc_ids=["doc-1"]).ids == simple.query(query, 3, doc_ids=["doc-1"]).ids
+
+
+def test_put_cache_with_slashed_branch(tmp_path):
+    repo_opts = RepoOptions(owner="o", repo="r", branch="feature/x")
+    cache_opts = CacheOptions(path=tmp_path)
+
+    _put_cache(b"abc", "docs.pkl", repo_opts, cache_opts)
+    assert _get_cache_path(repo_opts, cache_opts, "docs.pkl").parent == tmp_path
+    assert bytes(_get_cache("docs.pkl", repo_opts, cache_opts)) == b"abc"